@@ -2,9 +2,16 @@
 Cleaning object that performs an entire ETL on the selected file.
 """
 import argparse
+import os
+from contextlib import suppress
 from typing import Optional
-from collections.abc import Iterable
+from collections.abc import Iterable, Iterator
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 
 from life_expectancy.types import StrDict
 from life_expectancy import config
@@ -19,40 +26,148 @@ class DataCleaner:
         3) have a region indication in the index
     The ETL reshapes the data to be in a format where the indexes are in different columns
     and the all years are in a single column along with the values.
+    In `transformed_df` years are int16 and values float32, so a value such as 80.1 holds
+    80.099998 in memory; the written file keeps the original decimals.
     """
-    def __init__(self, input_fn: str):
+    def __init__(self, input_fn: str, use_cache: bool = False):
         self.input_fn: str = input_fn
+        self.use_cache: bool = use_cache
         self.raw_df: Optional[pd.DataFrame] = None
         self.transformed_df: Optional[pd.DataFrame] = None
 
+    @property
+    def cache_fn(self) -> str:
+        """Parquet copy of the raw input, reused while it is newer than the input"""
+        return f"{self.input_fn}.parquet"
+
+    def _is_cache_fresh(self) -> bool:
+        return (
+            self.use_cache
+            and os.path.exists(self.cache_fn)
+            and os.path.getmtime(self.cache_fn) >= os.path.getmtime(self.input_fn))
+
+    @property
+    def _tmp_cache_fn(self) -> str:
+        return f"{self.cache_fn}.tmp"
+
+    def _open_cache_writer(self, schema: pa.Schema) -> Optional[pq.ParquetWriter]:
+        # the cache is only an optimisation: skip it when it cannot be written
+        if not self.use_cache:
+            return None
+        try:
+            return pq.ParquetWriter(self._tmp_cache_fn, schema)
+        except OSError:
+            return None
+
+    def _convert_options(self) -> pacsv.ConvertOptions:
+        # read every column as a string: type inference only sees the first block, so a
+        # year column holding only numbers there would fail on a later ':'
+        with open(self.input_fn, encoding="utf-8") as input_file:
+            columns = input_file.readline().rstrip("\r\n").split("\t")
+        return pacsv.ConvertOptions(column_types={col: pa.string() for col in columns})
+
     # pylint: disable=C0116
     def extract(self) -> None:
-        self.raw_df = pd.read_csv(self.input_fn, sep="\t")
+        if self._is_cache_fresh():
+            table = pq.read_table(self.cache_fn)
+        else:
+            table = pacsv.read_csv(
+                self.input_fn,
+                parse_options=pacsv.ParseOptions(delimiter="\t"),
+                read_options=pacsv.ReadOptions(block_size=8 << 20, use_threads=True),
+                convert_options=self._convert_options())
+            writer = self._open_cache_writer(table.schema)
+            if writer is not None:
+                try:
+                    with writer:
+                        writer.write_table(table)
+                    os.replace(self._tmp_cache_fn, self.cache_fn)
+                finally:
+                    with suppress(FileNotFoundError):
+                        os.remove(self._tmp_cache_fn)
+        self.raw_df = table.to_pandas(types_mapper=pd.ArrowDtype)
+
+    def extract_batches(self, block_size: int = 16 << 20) -> Iterator[pd.DataFrame]:
+        """
+        Streams the file in blocks of `block_size` bytes, setting `raw_df` to each block
+        so that transform and load can be run once per block.
+        When the parquet cache is fresh it is streamed instead, in the parquet row batches
+        (`block_size` does not apply), otherwise it is rebuilt along the way and only kept
+        if the whole file was read.
+        """
+        if self._is_cache_fresh():
+            with pq.ParquetFile(self.cache_fn) as parquet_file:
+                for batch in parquet_file.iter_batches():
+                    self.raw_df = batch.to_pandas(types_mapper=pd.ArrowDtype)
+                    yield self.raw_df
+            return
+        reader = pacsv.open_csv(
+            self.input_fn,
+            parse_options=pacsv.ParseOptions(delimiter="\t"),
+            read_options=pacsv.ReadOptions(block_size=block_size, use_threads=True),
+            convert_options=self._convert_options())
+        writer = self._open_cache_writer(reader.schema)
+        try:
+            for batch in reader:
+                if writer is not None:
+                    writer.write_batch(batch)
+                self.raw_df = batch.to_pandas(types_mapper=pd.ArrowDtype)
+                yield self.raw_df
+            if writer is not None:
+                writer.close()
+                os.replace(self._tmp_cache_fn, self.cache_fn)
+        finally:
+            if writer is not None:
+                writer.close()
+                with suppress(FileNotFoundError):
+                    os.remove(self._tmp_cache_fn)
 
     def _transform_validations(self):
         assert self.raw_df is not None, "extract the data first"
 
-    def _reshape(self, id_vars: Iterable) -> None:
-        expanded_index = self.raw_df.iloc[:, 0].str.split(',', expand=True)
+    # pylint: disable=E1101
+    def _expand_index(self) -> None:
         index_cols = self.raw_df.columns[0].replace("\\", ",").split(",")[:-1]
-        expanded_index.columns = index_cols
-        year_values = self.raw_df.iloc[:, 1:]
-        year_values.columns = year_values.columns.str.strip()
-        years = year_values.columns
-        expanded_df = pd.concat([expanded_index, year_values], axis=1)
-        self.transformed_df = pd.melt(expanded_df, id_vars, years, var_name='year')
+        parts = pc.split_pattern(pa.array(self.raw_df.iloc[:, 0]), ',')
+        expanded_index = {
+            col: pc.list_element(parts, i).dictionary_encode().to_pandas()
+            for i, col in enumerate(index_cols)}
+        year_values = {
+            year.strip(): self.raw_df[year].array for year in self.raw_df.columns[1:]}
+        self.transformed_df = pd.DataFrame({**expanded_index, **year_values}, copy=False)
 
     def _rename(self, rename_cols: Optional[StrDict] = None):
         if rename_cols:
-            self.transformed_df.rename(columns=rename_cols, inplace=True)
+            self.transformed_df.columns = [
+                rename_cols.get(col, col) for col in self.transformed_df.columns]
 
     def _filter(self, region: list[str]) -> None:
-        self.transformed_df = self.transformed_df[self.transformed_df.region.isin(region)]
+        region_col = self.transformed_df.region.astype('category')
+        categories = region_col.cat.categories.str.upper()
+        wanted_codes = np.flatnonzero(categories.isin([reg.upper() for reg in region]))
+        mask = np.isin(region_col.cat.codes.to_numpy(), wanted_codes)
+        self.transformed_df = self.transformed_df[mask]
+
+    def _reshape(self, id_vars: Iterable) -> None:
+        years = self.raw_df.columns[1:].str.strip()
+        expanded_df = self.transformed_df
+        stacked = (
+            expanded_df.set_index(list(id_vars))[years]
+            .rename_axis(columns='year')
+            .stack()
+            .rename('value')
+            .reset_index())
+        # stack is row-major while melt was year-major: keep the melt row order
+        melt_order = np.arange(len(stacked)).reshape(len(expanded_df), len(years)).T.ravel()
+        self.transformed_df = stacked.take(melt_order).reset_index(drop=True)
+        self.transformed_df["year"] = self.transformed_df["year"].astype(np.int16)
 
     def _reformat(self) -> None:
-        value = self.transformed_df.value.str.extract(r'(\d+.\d)')
-        self.transformed_df["value"] = value.astype(float)
-        self.transformed_df = self.transformed_df[self.transformed_df.value.notnull()]
+        # stack gives an object column for an empty frame on pandas 2: pin the arrow dtype
+        value = self.transformed_df["value"].astype(pd.ArrowDtype(pa.string()))
+        value = value.str.split(' ', n=1).list[0]
+        self.transformed_df["value"] = pd.to_numeric(value, errors='coerce').astype(np.float32)
+        self.transformed_df = self.transformed_df.dropna(subset=["value"])
 
     # pylint: disable=C0116
     def transform(
@@ -61,32 +176,54 @@ class DataCleaner:
             region: list[str],
             rename_cols: Optional[StrDict] = None) -> None:
         self._transform_validations()
-        self._reshape(id_vars)
+        rename_cols = rename_cols or {}
+        # filter the wide frame so that only the selected regions get unpivoted
+        self._expand_index()
         self._rename(rename_cols)
         self._filter(region)
+        self._reshape([rename_cols.get(col, col) for col in id_vars])
         self._reformat()
 
     def _load_validations(self):
         assert self.transformed_df is not None, "transform the data first"
 
+    @staticmethod
+    def _format_floats(table: pa.Table) -> pa.Table:
+        # arrow writes integral floats as '78' where pandas writes '78.0'
+        for i, field in enumerate(table.schema):
+            if pa.types.is_floating(field.type):
+                text = pc.cast(table.column(i), pa.string())
+                integral = pc.match_substring_regex(text, r'^-?\d+$')
+                text = pc.if_else(integral, pc.binary_join_element_wise(text, '.0', ''), text)
+                table = table.set_column(i, field.name, text)
+        return table
+
     # pylint: disable=C0116
-    def load(self, output_fn: str) -> None:
+    def load(self, output_fn: str, append: bool = False) -> None:
         self._load_validations()
-        self.transformed_df.to_csv(output_fn, index=False)
+        table = self._format_floats(
+            pa.Table.from_pandas(self.transformed_df, preserve_index=False))
+        # the index components are comma split, so no value ever needs to be quoted;
+        # arrow always quotes the header, hence it is written by hand
+        write_options = pacsv.WriteOptions(include_header=False, quoting_style='none')
+        with open(output_fn, 'ab' if append else 'wb') as output_file:
+            if not append:
+                output_file.write((",".join(table.column_names) + "\n").encode())
+            pacsv.write_csv(table, output_file, write_options=write_options)
 
 
 # pylint: disable=W0102
-def clean_data(region: list[str] = ['PT']) -> None:
+def clean_data(region: list[str] = ['PT'], use_cache: bool = False) -> None:
     """
     Perform an ETL on the EU life expectancy file
     """
-    data_cleaner = DataCleaner(config.EU_LIFE_EXPECTANCY_FN)
-    data_cleaner.extract()
-    data_cleaner.transform(
-        ['unit', 'sex', 'age', 'geo'],
-        region,
-        {'geo': 'region'})
-    data_cleaner.load(config.PT_LIFE_EXPECTANCY_FN)
+    data_cleaner = DataCleaner(config.EU_LIFE_EXPECTANCY_FN, use_cache)
+    for i, _ in enumerate(data_cleaner.extract_batches()):
+        data_cleaner.transform(
+            ['unit', 'sex', 'age', 'geo'],
+            region,
+            {'geo': 'region'})
+        data_cleaner.load(config.PT_LIFE_EXPECTANCY_FN, append=i > 0)
 
 
 # pylint: disable=C0116
@@ -105,9 +242,14 @@ def parse_cli_args() -> dict:
         nargs='+',
         help="list of countries of the export in the final file"
     )
+    parser.add_argument(
+        "--use-cache",
+        action="store_true",
+        help="keep a parquet copy of the parsed input next to it and reuse it on later runs"
+    )
     return vars(parser.parse_args())
 
 
 if __name__ == "__main__":  # pragma: no cover
     args = parse_cli_args()
-    clean_data(args['region'])
+    clean_data(args['region'], args['use_cache'])
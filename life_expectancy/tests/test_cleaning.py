@@ -1,8 +1,11 @@
 """Tests for the cleaning module"""
+import shutil
+
 import pandas as pd
 
-from life_expectancy.cleaning import clean_data
-from . import OUTPUT_DIR
+from life_expectancy.cleaning import DataCleaner, clean_data
+from life_expectancy import config
+from . import FIXTURES_DIR, OUTPUT_DIR
 
 
 def test_clean_data(pt_life_expectancy_expected):
@@ -14,3 +17,73 @@ def test_clean_data(pt_life_expectancy_expected):
     pd.testing.assert_frame_equal(
         pt_life_expectancy_actual, pt_life_expectancy_expected
     )
+
+
+def test_clean_data_file_format():
+    """The written file matches the expected output byte for byte, floats included"""
+    clean_data()
+    actual = (OUTPUT_DIR / "pt_life_expectancy.csv").read_bytes()
+    expected = (FIXTURES_DIR / "pt_life_expectancy_expected.csv").read_bytes()
+    assert actual == expected
+
+
+def test_clean_data_unknown_region():
+    """A region with no rows in the input yields a file with only the header"""
+    clean_data(['XX'])
+    pt_life_expectancy_actual = pd.read_csv(
+        OUTPUT_DIR / "pt_life_expectancy.csv"
+    )
+    assert pt_life_expectancy_actual.empty
+    assert list(pt_life_expectancy_actual.columns) == [
+        'unit', 'sex', 'age', 'region', 'year', 'value']
+
+
+def test_clean_data_in_batches(pt_life_expectancy_expected):
+    """Stream the input in small blocks and compare the rows to the expected output"""
+    output_fn = OUTPUT_DIR / "pt_life_expectancy.csv"
+    data_cleaner = DataCleaner(config.EU_LIFE_EXPECTANCY_FN, use_cache=False)
+    for i, _ in enumerate(data_cleaner.extract_batches(block_size=1 << 18)):
+        data_cleaner.transform(['unit', 'sex', 'age', 'geo'], ['PT'], {'geo': 'region'})
+        data_cleaner.load(output_fn, append=i > 0)
+    pt_life_expectancy_actual = pd.read_csv(output_fn)
+    sort_cols = ['unit', 'sex', 'age', 'region', 'year']
+    pd.testing.assert_frame_equal(
+        pt_life_expectancy_actual.sort_values(sort_cols, ignore_index=True),
+        pt_life_expectancy_expected.sort_values(sort_cols, ignore_index=True)
+    )
+
+
+def test_extract_batches_keeps_columns_as_strings(tmp_path):
+    """A year column that is only numeric in the first block still accepts ':' later on"""
+    input_fn = tmp_path / "eu_life_expectancy_raw.tsv"
+    rows = [f"YR,F,Y{age},PT\t80.{age % 10} \t79.1 e" for age in range(100)]
+    rows += [f"YR,M,Y{age},PT\t: \t: " for age in range(100)]
+    input_fn.write_text("unit,sex,age,geo\\time\t2021 \t2020 \n" + "\n".join(rows) + "\n")
+    data_cleaner = DataCleaner(input_fn, use_cache=False)
+    batches = list(data_cleaner.extract_batches(block_size=1 << 10))
+    assert len(batches) > 1
+    assert sum(len(batch) for batch in batches) == 200
+
+
+def test_extract_parquet_cache(tmp_path):
+    """Extract twice and check that the second run reads the same data from the cache"""
+    input_fn = tmp_path / "eu_life_expectancy_raw.tsv"
+    shutil.copy(config.EU_LIFE_EXPECTANCY_FN, input_fn)
+    data_cleaner = DataCleaner(input_fn, use_cache=True)
+    data_cleaner.extract()
+    cache_fn = tmp_path / "eu_life_expectancy_raw.tsv.parquet"
+    cache_mtime = cache_fn.stat().st_mtime_ns
+    cached_cleaner = DataCleaner(input_fn, use_cache=True)
+    cached_cleaner.extract()
+    assert cache_fn.stat().st_mtime_ns == cache_mtime
+    pd.testing.assert_frame_equal(cached_cleaner.raw_df, data_cleaner.raw_df)
+
+
+def test_extract_batches_abandoned_leaves_no_cache(tmp_path):
+    """Stopping the stream early discards the partial cache instead of leaving it behind"""
+    input_fn = tmp_path / "eu_life_expectancy_raw.tsv"
+    shutil.copy(config.EU_LIFE_EXPECTANCY_FN, input_fn)
+    batches = DataCleaner(input_fn, use_cache=True).extract_batches(block_size=1 << 18)
+    next(batches)
+    batches.close()
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["eu_life_expectancy_raw.tsv"]